@@ -1,16 +1,23 @@
+from __future__ import annotations
+
 import streamlit as st
-import pandas as pd
 from datetime import datetime, timedelta, date
-import re
-import json
+import html
 import io
-from typing import Tuple
+from dataclasses import dataclass
+import copy
+import queue
+import time
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from functools import lru_cache
+from typing import TYPE_CHECKING, Tuple
+from urllib.parse import urlsplit
 import streamlit.components.v1 as components
 from prompt import system_prompt
 
-# Firebase Admin SDK
-import firebase_admin
-from firebase_admin import credentials, db as firebase_db
+if TYPE_CHECKING:
+    import pandas as pd
 
 # --- 基礎設定 ---
 st.set_page_config(layout="wide", page_title="楓之谷組隊系統", page_icon="🍁")
@@ -25,16 +32,47 @@ JOB_OPTIONS = {
     "🧙‍♂️ 法師": ["火毒", "冰雷", "祭司"]
 }
 JOB_SELECT_LIST = [job for sublist in JOB_OPTIONS.values() for job in sublist]
+JOB_INDEX = {job: i for i, job in enumerate(JOB_SELECT_LIST)}
 UNAVAILABLE_KEY = "__UNAVAILABLE__"
+# 週期為星期四至星期三，依序對應 availability 的鍵
+WEEKDAY_PLAIN = ["星期四", "星期五", "星期六", "星期日", "星期一", "星期二", "星期三"]
 DUNGEON_OPTIONS = ["拉圖斯", "殘暴炎魔"]
 DEFAULT_DUNGEON = DUNGEON_OPTIONS[0]
+_DUNGEON_SET = frozenset(DUNGEON_OPTIONS)
+DUNGEON_INDEX = {dungeon: i for i, dungeon in enumerate(DUNGEON_OPTIONS)}
+# 資料結構版本：載入時若與此不同才執行舊欄位遷移與副本欄位升級
+# （修改遷移邏輯時請同步遞增）
+SCHEMA_VERSION = 3
 
 
 def normalize_dungeon(dungeon: str) -> str:
     """將輸入的副本名稱修正為合法值，預設為 DEFAULT_DUNGEON。"""
-    if isinstance(dungeon, str) and dungeon in DUNGEON_OPTIONS:
-        return dungeon
-    return DEFAULT_DUNGEON
+    try:
+        return dungeon if dungeon in _DUNGEON_SET else DEFAULT_DUNGEON
+    except TypeError:  # 不可雜湊的值（如 dict / list）
+        return DEFAULT_DUNGEON
+
+def _safe_dict(d: dict, key) -> dict:
+    """取出 d[key]；若不存在或不是 dict（RTDB 可能存成其他型別）則回傳空 dict。"""
+    value = d.get(key)
+    return value if type(value) is dict else {}
+
+def _blank_member() -> dict:
+    """隊伍的空白成員欄位（與組隊頁面清空成員時的格式相同）。"""
+    return {"name": "", "job": "", "level": "", "atk": ""}
+
+# RTDB 的鍵不可包含的字元（"/" 會被當成路徑分隔，寫到巢狀或其他成員的節點）
+_RTDB_KEY_FORBIDDEN = frozenset(".$#[]/")
+
+def is_valid_member_name(name: str) -> bool:
+    """成員名稱會直接作為 RTDB 路徑中的鍵：不可為空，也不可包含 . $ # [ ] /。"""
+    return bool(name) and _RTDB_KEY_FORBIDDEN.isdisjoint(name)
+
+def _member_path(name: str) -> str:
+    """回傳成員節點路徑；名稱不合法時拋出 ValueError，不組出錯誤的路徑。"""
+    if not is_valid_member_name(name):
+        raise ValueError(f"成員名稱不可為空或包含 . $ # [ ] /：{name!r}")
+    return f"members/{name}"
 
 # --- 核心函式 ---
 
@@ -45,24 +83,17 @@ def _parse_firebase_url(full_url: str) -> Tuple[str, str]:
     """
     if not full_url:
         raise ValueError("firebase.url is empty in secrets")
-    url = full_url.strip()
-    if url.endswith(".json"):
-        url = url[:-5]
-    url = url.rstrip("/")
-
-    marker = ".com"
-    idx = url.find(marker)
-    if idx == -1:
-        raise ValueError("Invalid Firebase RTDB URL: missing '.com'")
-    base = url[: idx + len(marker)]
-    path = url[idx + len(marker) :]
-    path = path if path else "/"
-    if not path.startswith("/"):
-        path = "/" + path
-    return base, path
+    parts = urlsplit(full_url.strip().removesuffix(".json").rstrip("/"))
+    if not parts.scheme or not parts.netloc:
+        raise ValueError("Invalid Firebase RTDB URL: missing scheme or host")
+    return f"{parts.scheme}://{parts.netloc}", parts.path or "/"
 
 def _init_firebase_admin_if_needed():
     """使用 Service Account 初始化 Firebase Admin（僅初始化一次）。"""
+    # Firebase Admin SDK 延後到第一次存取資料庫才載入，縮短冷啟動時間
+    import firebase_admin
+    from firebase_admin import credentials
+
     if not firebase_admin._apps:
         service_account_info = dict(st.secrets["gcp_service_account"])  # from secrets.toml / cloud secrets
         database_url_full = st.secrets["firebase"]["url"]
@@ -72,13 +103,17 @@ def _init_firebase_admin_if_needed():
             "databaseURL": database_url_base
         })
 
+@st.cache_resource(show_spinner=False)
 def _get_rtdb_ref():
-    """回傳專案資料的 RTDB 參照。"""
+    """回傳專案資料的 RTDB 參照（每個伺服器程序只建立一次）。"""
+    from firebase_admin import db as firebase_db
+
     _init_firebase_admin_if_needed()
     database_url_full = st.secrets["firebase"]["url"]
     _, ref_path = _parse_firebase_url(database_url_full)
     return firebase_db.reference(ref_path)
 
+@lru_cache(maxsize=16)
 def get_start_of_week(base_date: date) -> date:
     """計算給定日期所在週的星期四是哪一天。
     週期為星期四至星期三，不做額外跳週調整。
@@ -121,7 +156,7 @@ def _upgrade_dungeon_schema(data: dict):
                 continue
 
             # 若已是「多副本」結構（key 為副本名稱，value 為 dict）
-            if any(isinstance(v, dict) and k in DUNGEON_OPTIONS for k, v in week_obj.items()):
+            if any(isinstance(v, dict) and k in _DUNGEON_SET for k, v in week_obj.items()):
                 for dungeon_name, dungeon_obj in week_obj.items():
                     if not isinstance(dungeon_obj, dict):
                         week_obj[dungeon_name] = {}
@@ -146,176 +181,321 @@ def _upgrade_dungeon_schema(data: dict):
     return data
 
 
-def load_data():
-    """從 Firebase 載入、遷移並驗證資料結構（使用 Admin SDK）。"""
-    try:
-        ref = _get_rtdb_ref()
-        data = ref.get()
+@st.cache_data(ttl=30, show_spinner=False)
+def _fetch_raw_data():
+    """讀取 RTDB 原始資料；多個 session 在 TTL 內共用同一份快照。"""
+    return _get_rtdb_ref().get()
 
-        if data is None:
-            return {"teams": [], "members": {}}
+def _invalidate_snapshots():
+    """寫入成功後清除資料快照快取。
+    本頁的 _fetch_raw_data 與組隊頁面的 _fetch_snapshot 都由所有 session 共用，且兩頁的函式無法互相引用，
+    故直接清除整個 st.cache_data，讓兩邊下次載入都讀到最新資料。
+    """
+    st.cache_data.clear()
+
+
+def _normalize_data(data):
+    """遷移並驗證資料結構（純 CPU 處理；僅在 schema_version 過舊時執行舊欄位遷移並回寫一次）。"""
+    if data is None:
+        return {"teams": [], "members": {}}
 
-        data.setdefault("teams", [])
-        data.setdefault("members", {})
+    data.setdefault("teams", [])
+    data.setdefault("members", {})
+    needs_migration = data.get("schema_version") != SCHEMA_VERSION
 
-        today = date.today()
-        start_of_this_week = get_start_of_week(today)
-        start_of_this_week_str = start_of_this_week.strftime('%Y-%m-%d')
-        start_of_next_week_str = (start_of_this_week + timedelta(days=7)).strftime('%Y-%m-%d')
-        valid_week_keys = {start_of_this_week_str, start_of_next_week_str}
+    weeks = week_labels(date.today())
+    start_of_this_week_str = weeks.key_this
+    valid_week_keys = {weeks.key_this, weeks.key_next}
 
-        for team in data["teams"]:
+    for team in data["teams"]:
+        if needs_migration:
             # 資料結構遷移：舊的 schedule -> 新的 schedules
             if "schedule" in team and "schedules" not in team:
                 old_schedule = team.pop("schedule")
                 start_date_key = old_schedule.pop("schedule_start_date", start_of_this_week_str)
                 team["schedules"] = {start_date_key: old_schedule}
 
-            team.setdefault("schedules", {})
-
-            # 清理過期的週次資料
-            current_schedules = team.get("schedules", {})
-            managed_schedules = {key: value for key, value in current_schedules.items() if key in valid_week_keys}
-
-            # ### 【健壯性優化】 ###
-            # 確保本週與下週的行程資料存在且結構完整
-            for week_key in valid_week_keys:
-                if week_key not in managed_schedules:
-                    managed_schedules[week_key] = get_default_schedule_for_week()
-                else:
-                    # 確保即使週次存在，其內部結構也是完整的
-                    managed_schedules[week_key].setdefault("proposed_slots", {})
-                    managed_schedules[week_key].setdefault("availability", {UNAVAILABLE_KEY: []})
-                    managed_schedules[week_key].setdefault("final_time", "")
-
-            team["schedules"] = managed_schedules
-
             # 資料結構遷移：舊的 boss_times -> 新的 team_remark
             if "boss_times" in team and "team_remark" not in team:
                 team["team_remark"] = team.pop("boss_times")
-            else:
-                team.setdefault("team_remark", "")
+        team.setdefault("team_remark", "")
+
+        # 清理過期的週次資料（週次會隨日期變動，且 RTDB 不保存空物件，故每次載入都要補齊）
+        current_schedules = team.get("schedules")
+        if not current_schedules:
+            current_schedules = team["schedules"] = {}
+        for week_key in list(current_schedules):
+            if week_key not in valid_week_keys:
+                del current_schedules[week_key]
+
+        # ### 【健壯性優化】 ###
+        # 確保本週與下週的行程資料存在且結構完整（既有週次原地補齊缺少的欄位，不另建新 dict）
+        for week_key in valid_week_keys:
+            week_schedule = current_schedules.get(week_key)
+            if type(week_schedule) is not dict:
+                current_schedules[week_key] = get_default_schedule_for_week()
+                continue
+            if "proposed_slots" not in week_schedule:
+                week_schedule["proposed_slots"] = {}
+            if "availability" not in week_schedule:
+                week_schedule["availability"] = {UNAVAILABLE_KEY: []}
+            if "final_time" not in week_schedule:
+                week_schedule["final_time"] = ""
+
+    if needs_migration:
+        # 升級資料結構：加入副本欄位（讀取端皆以 normalize_dungeon 容錯，升級後不必每次重跑）
+        data = _upgrade_dungeon_schema(data)
+        # 遷移結果只回寫一次（save_data 會蓋上 schema_version），之後的載入即可略過上述舊欄位遷移
+        save_data(data)
+    return data
 
-        # 升級資料結構：加入副本欄位
-        return _upgrade_dungeon_schema(data)
 
+def load_data(use_cache: bool = True):
+    """從 Firebase 載入、遷移並驗證資料結構（使用 Admin SDK）。
+    use_cache=False 時略過共用快照，直接讀取最新資料（例如背景寫入失敗後要回復畫面時）。
+    """
+    try:
+        data = _fetch_raw_data() if use_cache else _get_rtdb_ref().get()
+        if use_cache and isinstance(data, dict) and data.get("schema_version") != SCHEMA_VERSION:
+            # 需要遷移時會整棵回寫，快取快照可能落後其他 session 剛送出的寫入，改讀最新資料
+            data = _get_rtdb_ref().get()
+        return _normalize_data(data)
     except Exception as e:
         st.error(f"❌ 載入資料時發生未預期的錯誤：{e}, {e.__traceback__.tb_lineno}")
 
     return {"teams": [], "members": {}}
 
+@st.cache_resource(show_spinner=False)
+def _get_write_executor() -> ThreadPoolExecutor:
+    """背景寫入用的執行緒池（單一 worker，確保寫入依送出順序抵達 RTDB）。"""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="rtdb-write")
+
+# 背景送出前稍等一下，讓同一時間（含其他 session）送出的 patch 能合併成一次 update
+_COALESCE_WINDOW_S = 0.15
+# 送出後的下一次 rerun 最多等待背景寫入結果的秒數（逾時者留待之後的 rerun 再檢查）
+_WRITE_RESULT_TIMEOUT_S = 5.0
+
+@st.cache_resource(show_spinner=False)
+def _get_patch_queue() -> queue.SimpleQueue:
+    """等待送出的 (多路徑 patch, Future)（每個伺服器程序共用一個佇列）。"""
+    return queue.SimpleQueue()
+
+def _paths_overlap(a: str, b: str) -> bool:
+    """兩個路徑互為祖先/子孫時 RTDB 不允許放在同一次多路徑 update。"""
+    return a != b and (a.startswith(b + "/") or b.startswith(a + "/"))
+
+def _coalesce_patches(entries: list):
+    """依送出順序合併 patch；遇到路徑互相包含時切成下一批，維持與逐筆寫入相同的結果。
+    entries 為 (patch, future) 的清單，每批連同其中各 patch 的 future 一起產出。
+    """
+    batch, futures = {}, []
+    for patch, future in entries:
+        if batch and any(_paths_overlap(path, queued) for path in patch for queued in batch):
+            yield batch, futures
+            batch, futures = {}, []
+        batch.update(patch)
+        futures.append(future)
+    if batch:
+        yield batch, futures
+
+def _flush_patches(ref, pending: queue.SimpleQueue):
+    """取出佇列中目前所有的 patch，合併成最少次數的 update 送出。
+    每個 patch 的 future 以其所在批次的結果完成；某批失敗時仍繼續送出後面的批次。
+    """
+    if pending.empty():  # 已被前一次 flush 一併送出，不必再空等合併時間
+        return
+    time.sleep(_COALESCE_WINDOW_S)
+    entries = []
+    while True:
+        try:
+            entries.append(pending.get_nowait())
+        except queue.Empty:
+            break
+    if not entries:  # 已被前一次 flush 一併送出
+        return
+    for batch, futures in _coalesce_patches(entries):
+        try:
+            ref.update(batch)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+        else:
+            for future in futures:
+                future.set_result(None)
+    _invalidate_snapshots()
+
+def _submit_patch(patch: dict):
+    """樂觀更新：呼叫端已先改好 session_state，這裡只把多路徑 update 排入背景佇列，不等待網路往返。
+    結果於下次 rerun 由 _report_pending_writes 等待並檢查。
+    """
+    try:
+        ref = _get_rtdb_ref()
+        pending = _get_patch_queue()
+        # 複製一份，避免背景序列化時 session_state 中的同一物件被改動；
+        # future 由實際送出此 patch 的那次 flush 完成（可能是其他 session 觸發的）
+        future = Future()
+        pending.put((copy.deepcopy(patch), future))
+        _get_write_executor().submit(_flush_patches, ref, pending)
+    except Exception as e:
+        st.error(f"❌ 儲存資料時發生未預期的錯誤：{e}")
+        return
+    st.session_state.setdefault("pending_writes", []).append(future)
+
+def _report_pending_writes():
+    """檢查背景寫入結果：送出後的下一次 rerun 會在有限時間內等待結果。
+    任一寫入失敗時顯示錯誤，並改用最新的遠端資料取代 session_state 中已樂觀更新、但實際未寫入的內容。
+    """
+    pending = st.session_state.get("pending_writes")
+    if not pending:
+        return
+    done, not_done = wait(pending, timeout=_WRITE_RESULT_TIMEOUT_S)
+    st.session_state.pending_writes = list(not_done)
+    errors = [e for e in (future.exception() for future in done) if e is not None]
+    if errors:
+        st.session_state.data = load_data(use_cache=False)
+        for e in errors:
+            st.error(f"❌ 儲存資料時發生未預期的錯誤：{e}")
+
+def save_member(name: str, fields: dict):
+    """只更新單一成員節點中的指定欄位，不覆寫整棵資料樹。"""
+    member_path = _member_path(name)
+    _submit_patch({f"{member_path}/{field}": value for field, value in fields.items()})
+
+def save_member_week(name: str, week_key: str, dungeon: str, payload: dict, legacy_fields: dict):
+    """只寫入成員某週某副本的報名資料，並同步舊欄位（一次多路徑 update）。"""
+    member_path = _member_path(name)
+    patch = {f"{member_path}/weekly_data/{week_key}/{dungeon}": payload}
+    patch.update({f"{member_path}/{field}": value for field, value in legacy_fields.items()})
+    _submit_patch(patch)
+
+def build_member_team_index(teams) -> dict:
+    """建立 成員名稱 → [(隊伍索引, 欄位索引), ...] 的反查表（刪除成員時只需處理相關欄位）。
+    teams 可為 list，或 RTDB 陣列有缺號時回傳的 dict（索引 → 隊伍）；不是 dict 的隊伍/欄位直接略過。
+    """
+    index = {}
+    for team_idx, team in (teams.items() if isinstance(teams, dict) else enumerate(teams)):
+        members = team.get("member") if isinstance(team, dict) else None
+        if not members:
+            continue
+        for slot_idx, m in (members.items() if isinstance(members, dict) else enumerate(members)):
+            name = m.get("name") if isinstance(m, dict) else None
+            if name:
+                index.setdefault(name, []).append((team_idx, slot_idx))
+    return index
+
+def delete_member(name: str) -> bool:
+    """刪除成員節點，並把其所在的隊伍欄位清成空白；成功排入寫入時回傳 True。
+    隊伍可能已被組隊頁面或其他 session 刪除或調整，故送出前直接讀取最新 teams（不經快取）依名稱定位欄位，
+    只寫入目前存在且名稱相符的欄位，不會在已不存在的隊伍索引下建立殘缺節點。
+    所有路徑合併成一次多路徑 update，單次往返且原子寫入。
+    """
+    member_path = _member_path(name)
+    try:
+        teams = _get_rtdb_ref().child("teams").get() or []
+    except Exception as e:
+        st.error(f"❌ 讀取隊伍資料時發生未預期的錯誤：{e}")
+        return False
+    patch = {member_path: None}
+    patch.update({
+        f"teams/{team_idx}/member/{slot_idx}": _blank_member()
+        for team_idx, slot_idx in build_member_team_index(teams).get(name, [])
+    })
+    _submit_patch(patch)
+    return True
+
 def save_data(data):
-    """將資料儲存到 Firebase（使用 Admin SDK）。"""
+    """將整份資料儲存到 Firebase（使用 Admin SDK），僅供整體遷移使用。
+    寫入前一律蓋上目前的 schema_version，整棵寫回的資料即視為已遷移。
+    """
+    data["schema_version"] = SCHEMA_VERSION
     try:
         ref = _get_rtdb_ref()
         # 直接 set Python 物件，Admin SDK 會處理序列化
         ref.set(data)
+        _invalidate_snapshots()
     except Exception as e:
         st.error(f"❌ 儲存資料時發生未預期的錯誤：{e}")
 
-def build_team_text(team):
-    """產生用於複製到 Discord 的隊伍資訊文字"""
-    today = date.today()
-    start_of_this_week_str = get_start_of_week(today).strftime('%Y-%m-%d')
-    this_week_schedule = team.get('schedules', {}).get(start_of_this_week_str, {})
-    final_time = this_week_schedule.get('final_time', '')
-    time_display = final_time if final_time else "時間待定"
-    dungeon = normalize_dungeon(team.get("dungeon", DEFAULT_DUNGEON))
-    remark = team.get('team_remark', '')
-
-    title = f"【{team['team_name']} 徵人】"
-    dungeon_line = f"副本：{dungeon}"
-    time = f"時間：{time_display}"
-    remark_text = f"備註：{remark}" if remark else ""
-
-    current_members = [m for m in team.get("member", []) if m.get("name")]
-    members_lines = [
-        f"{i}. {member.get('level','')} {member.get('job','')} {member.get('name')}".strip()
-        for i, member in enumerate(current_members, 1)
-    ]
-    member_text = "✅ 目前成員：\n" + "\n".join(members_lines) if members_lines else ""
-
-    missing_count = MAX_TEAM_SIZE - len(current_members)
-    missing_text = f"📋 尚缺 {missing_count} 人，歡迎私訊！" if missing_count > 0 else "🎉 隊伍已滿，可先排後補！"
-
-    return "\n\n".join(filter(None, [title, dungeon_line, time, remark_text, member_text, missing_text])).strip()
-
-def render_global_weekly_availability():
-    """Render 本週與下週可參加名單（唯讀）。"""
-    st.markdown("---")
-    st.subheader("全局：本週與下週可參加名單（唯讀）")
-    today = date.today()
-    start_this = get_start_of_week(today)
-    this_range = f"{start_this.strftime('%m/%d')} ~ {(start_this + timedelta(days=6)).strftime('%m/%d')}"
-    next_start = start_this + timedelta(days=7)
-    next_range = f"{next_start.strftime('%m/%d')} ~ {(next_start + timedelta(days=6)).strftime('%m/%d')}"
-    label_this = f"本週({this_range})"
-    label_next = f"下週({next_range})"
-    week_view = st.radio("檢視週次", [label_this, label_next], horizontal=True)
-    week_start = start_this if week_view == label_this else start_this + timedelta(days=7)
-    week_days = generate_weekly_schedule_days(week_start)
-
-    rows = []
-    for name, info in st.session_state.data.get("members", {}).items():
-        wa = info.get("weekly_availability", {})
-        # 只顯示在該週內有填寫的成員資訊
-        if not any(wa.get(d, False) for d in week_days):
-            continue
-        row = {"名稱": name, "職業": info.get("job", ""), "等級": info.get("level", "")}
-        mapping = {
-            week_days[0]: "星期四",
-            week_days[1]: "星期五",
-            week_days[2]: "星期六",
-            week_days[3]: "星期日",
-            week_days[4]: "星期一",
-            week_days[5]: "星期二",
-            week_days[6]: "星期三",
-        }
-        for label in week_days:
-            wk = mapping[label]
-            row[label] = "✅" if wa.get(wk, False) else ""
-        rows.append(row)
-    df_week = pd.DataFrame(rows, columns=["名稱","職業","等級"] + week_days)
-    if not df_week.empty:
-        st.dataframe(df_week)
-    else:
-        st.info("本週尚無成員勾選可參加日期。")
-    return
-
+@lru_cache(maxsize=16)
 def get_week_range(base_date: date) -> str:
     """產生週次的日期範圍字串，例如 '08/14 ~ 08/20'"""
     start_of_week = get_start_of_week(base_date)
     end_of_week = start_of_week + timedelta(days=6)
     return f"{start_of_week.strftime('%m/%d')} ~ {end_of_week.strftime('%m/%d')}"
 
-def generate_weekly_schedule_days(start_date: date) -> list[str]:
-    """根據開始日期產生一週七天的字串列表"""
-    start_of_week = get_start_of_week(start_date)
-    weekdays_zh = ["一", "二", "三", "四", "五", "六", "日"]
-    schedule_days = [
-        f"星期{weekdays_zh[(start_of_week + timedelta(days=i)).weekday()]} ({(start_of_week + timedelta(days=i)).strftime('%m-%d')})"
-        for i in range(7)
-    ]
-    return schedule_days
+@lru_cache(maxsize=16)
+def weekday_column_labels(week_start: date) -> tuple[str, ...]:
+    """已報名成員表格的星期欄名，例如 '星期四(08/14)'（依週快取）"""
+    return tuple(
+        f"{plain}({(week_start + timedelta(days=i)).strftime('%m/%d')})"
+        for i, plain in enumerate(WEEKDAY_PLAIN)
+    )
+
+WeekLabels = namedtuple(
+    "WeekLabels", ["start_this", "start_next", "key_this", "key_next", "label_this", "label_next"]
+)
+
+@lru_cache(maxsize=2)
+def week_labels(today: date) -> WeekLabels:
+    """本週/下週的起始日、資料鍵（YYYY-MM-DD）與選單標籤，同一天內共用。"""
+    start_this = get_start_of_week(today)
+    start_next = start_this + timedelta(days=7)
+    return WeekLabels(
+        start_this=start_this,
+        start_next=start_next,
+        key_this=start_this.strftime('%Y-%m-%d'),
+        key_next=start_next.strftime('%Y-%m-%d'),
+        label_this=f"本週({get_week_range(start_this)})",
+        label_next=f"下週({get_week_range(start_next)})",
+    )
+
+def _week_view(info: dict, week_key: str) -> list[tuple[str, dict, object]]:
+    """回傳成員在指定週次的 (副本, availability, 參與次數) 清單。
+    優先讀取 weekly_data（同一週可有多個副本），否則退回舊的單副本欄位。
+    """
+    get = info.get
+    week_obj = _safe_dict(_safe_dict(info, "weekly_data"), week_key)
+    if week_obj:
+        return [
+            (
+                normalize_dungeon(dungeon_key or dungeon_obj.get("dungeon", DEFAULT_DUNGEON)),
+                dungeon_obj.get("availability", {}) or {},
+                dungeon_obj.get("participation_count", ""),
+            )
+            for dungeon_key, dungeon_obj in week_obj.items()
+            if isinstance(dungeon_obj, dict)
+        ]
+    if get("weekly_week_start") != week_key:
+        return []
+    return [(
+        normalize_dungeon(get("weekly_dungeon", DEFAULT_DUNGEON)),
+        get("weekly_availability", {}) or {},
+        get("weekly_participation_count", ""),
+    )]
+
+def build_signup_dataframe(rows, weekday_labels: list) -> pd.DataFrame:
+    """將已報名成員資料列一次建成 DataFrame，再以向量化方式把可參加日轉成 ✅ 標記。"""
+    import numpy as np
+    import pandas as pd
+
+    df = pd.DataFrame.from_records(rows, columns=["名稱","職業","等級","副本","次數"] + weekday_labels)
+    df[weekday_labels] = np.where(df[weekday_labels].to_numpy(dtype=bool), "✅", "")
+    return df
 
 def dataframe_to_markdown(df: pd.DataFrame) -> str:
     """將 DataFrame 轉成 Markdown 表格字串，供 prompt 使用。"""
     if df.empty:
         return ""
-    columns = df.columns.tolist()
+    columns = [str(c) for c in df.columns]
     header = "| " + " | ".join(columns) + " |"
     separator = "| " + " | ".join("---" for _ in columns) + " |"
-    rows = []
-    for row in df.itertuples(index=False):
-        cells = [
-            "" if pd.isna(value) else str(value)
-            for value in row
-        ]
-        rows.append("| " + " | ".join(cells) + " |")
-    return "\n".join([header, separator] + rows)
+    # 缺值轉空字串後整列一次串接，不逐格呼叫 pd.isna / str
+    body = df.fillna("").astype(str).agg(" | ".join, axis=1).radd("| ").add(" |")
+    return "\n".join([header, separator, *body])
 
+@st.cache_data(max_entries=8, show_spinner=False)
 def build_prompt_from_table(df: pd.DataFrame) -> str:
-    """套入 Markdown 內容並回傳最終 prompt 文案。"""
+    """套入 Markdown 內容並回傳最終 prompt 文案（st.cache_data 以表格內容雜湊為鍵，內容不變即直接取用）。"""
     markdown_table = dataframe_to_markdown(df)
     if not markdown_table:
         markdown_table = "目前無顯示成員資料。"
@@ -338,21 +518,20 @@ def download_members_csv():
             # 準備 CSV 資料
             all_members = st.session_state.data.get("members", {})
             if all_members:
-                members_data = []
-                for name, info in all_members.items():
-                    members_data.append({
-                        "遊戲ID": name,
-                        "職業": info.get("job", ""),
-                        "等級": info.get("level", ""),
-                        "表攻": info.get("atk", ""),
-                        "公會成員": "是" if info.get("is_guild_member", True) else "否"
-                    })
-                
-                df = pd.DataFrame(members_data)
+                import pandas as pd
+
+                # 直接由成員 dict 以欄為單位建立 DataFrame（缺欄位者為空值）
+                df = pd.DataFrame.from_dict(
+                    all_members, orient="index", columns=["job", "level", "atk", "is_guild_member"]
+                )
+                df.index.name = "遊戲ID"
+                df = df.reset_index()
+                df["公會成員"] = df["is_guild_member"].fillna(True).astype(bool).map({True: "是", False: "否"})
+                df = df.rename(columns={"job": "職業", "level": "等級", "atk": "表攻"})[["遊戲ID", "職業", "等級", "表攻", "公會成員"]]
                 
-                # 轉換為 CSV
-                csv_buffer = io.StringIO()
-                df.to_csv(csv_buffer, index=False, encoding='utf-8-sig')
+                # 直接寫成位元組（utf-8-sig 帶 BOM，Excel 開啟中文不會亂碼），download_button 不必再編碼一次
+                csv_buffer = io.BytesIO()
+                df.to_csv(csv_buffer, index=False, encoding="utf-8-sig")
                 csv_data = csv_buffer.getvalue()
                 
                 # 產生檔案名稱
@@ -379,12 +558,16 @@ def download_members_csv():
 if "data" not in st.session_state:
     st.session_state.data = load_data()
 
+_report_pending_writes()
+
 if "team_view_week" not in st.session_state:
     st.session_state.team_view_week = {}
 
-def sync_data_and_save():
-    """將 session state 中的資料儲存到 Firebase"""
-    save_data(st.session_state.data)
+# 成員名單與排序後的 ID 每次 rerun 只計算一次，供各個選單共用
+all_members = st.session_state.data.get("members", {})
+member_keys_sorted = tuple(sorted(all_members))
+# 選單選項以不可變 tuple 建好一次，各元件共用同一個物件
+signup_member_options = ("", *member_keys_sorted)
 
 # --- UI 介面 ---
 st.title("🍁 Monarchs 公會組隊系統")
@@ -413,8 +596,6 @@ st.header("👤 公會成員表")
 if "profile_expander_open" not in st.session_state:
     st.session_state.profile_expander_open = False
 with st.expander("點此註冊或更新你的個人資料", expanded=st.session_state.profile_expander_open):
-    all_members = st.session_state.data.get("members", {})
-
     # 選單選擇既有ID後自動帶入到輸入框（放在表單外，避免 on_change 限制）
     def _on_pick_existing_member():
         picked = st.session_state.get("member_id_select_existing", "")
@@ -425,10 +606,9 @@ with st.expander("點此註冊或更新你的個人資料", expanded=st.session_
             st.session_state["member_id_input_main"] = ""
         st.session_state.profile_expander_open = True
 
-    member_options = sorted(list(all_members.keys()))
     st.selectbox(
         "從名單選擇（將自動帶入下方輸入框）",
-        options=["<創建成員>"] + member_options,
+        options=("<創建成員>", *member_keys_sorted),
         key="member_id_select_existing",
         on_change=_on_pick_existing_member,
     )
@@ -439,7 +619,7 @@ with st.expander("點此註冊或更新你的個人資料", expanded=st.session_
         member_id_input = c1.text_input("遊戲ID", key="member_id_input_main", disabled=st.session_state.get("member_id_input_main", "") in all_members)
         selected_member_name = member_id_input if member_id_input in all_members else ""
         default_info = all_members.get(selected_member_name, {"job": "", "level": "", "atk": "", "is_guild_member": True})
-        job_index = JOB_SELECT_LIST.index(default_info.get("job", "")) if default_info.get("job") in JOB_SELECT_LIST else 0
+        job_index = JOB_INDEX.get(default_info.get("job", ""), 0)
         job_input = c2.selectbox("職業", options=JOB_SELECT_LIST, index=job_index, disabled=False)
         level_input = c3.text_input("等級", value=default_info.get("level", ""))
         atk_input = c4.text_input("表攻 (乾表)", value=default_info.get("atk", ""))
@@ -451,32 +631,36 @@ with st.expander("點此註冊或更新你的個人資料", expanded=st.session_
             final_name = (member_id_input or "").strip()
             if not final_name:
                 st.warning("請務必填寫遊戲ID！")
+            elif not is_valid_member_name(final_name):
+                st.warning("遊戲ID 不可包含 . $ # [ ] / 等字元！")
             else:
                 member_dict = st.session_state.data.setdefault("members", {}).get(final_name, {})
                 # 僅儲存基本資料（不動每週報名資料）
-                member_dict.update({
+                profile_fields = {
                     "job": job_input,
                     "level": level_input,
                     "atk": atk_input,
                     "is_guild_member": is_guild_member,
-                })
+                }
+                member_dict.update(profile_fields)
                 st.session_state.data["members"][final_name] = member_dict
-                sync_data_and_save()
+                save_member(final_name, profile_fields)
                 st.success(f"角色 '{final_name}' 的資料已儲存！")
                 st.session_state.profile_expander_open = True
                 st.rerun()
 
         if selected_member_name and btn_cols[1].form_submit_button("🗑️ 刪除此角色"):
-            del st.session_state.data["members"][selected_member_name]
-            # 同步刪除隊伍中的成員
-            for team_idx in range(len(st.session_state.data['teams'])):
-                st.session_state.data['teams'][team_idx]['member'] = [
-                    m for m in st.session_state.data['teams'][team_idx].get('member', []) if m.get('name') != selected_member_name
-                ]
-            sync_data_and_save()
-            st.success(f"角色 '{selected_member_name}' 已從名冊中刪除！")
-            st.session_state.profile_expander_open = True
-            st.rerun()
+            # 遠端欄位由 delete_member 依最新 teams 定位；本 session 的隊伍資料則依名稱清空
+            if delete_member(selected_member_name):
+                del st.session_state.data["members"][selected_member_name]
+                for team in st.session_state.data['teams']:
+                    members = team.get('member', [])
+                    for slot_idx, m in enumerate(members):
+                        if isinstance(m, dict) and m.get('name') == selected_member_name:
+                            members[slot_idx] = _blank_member()
+                st.success(f"角色 '{selected_member_name}' 已從名冊中刪除！")
+                st.session_state.profile_expander_open = True
+                st.rerun()
 
     # 下載功能放在表單外面
     st.markdown("---")
@@ -488,40 +672,57 @@ st.markdown("---")
 # ------ 每週報名（快速） ------
 st.header("📅 每週報名")
 signup_cols = st.columns([1, 1, 1, 1])
-all_members = st.session_state.data.get("members", {})
 
 # 快速選擇ID（搜尋 + 記住上次選擇）
 default_member_idx = 0
-member_keys_sorted = sorted(list(all_members.keys()))
-if "last_signup_member" in st.session_state and st.session_state["last_signup_member"] in member_keys_sorted:
-    default_member_idx = member_keys_sorted.index(st.session_state["last_signup_member"]) + 1
+if st.session_state.get("last_signup_member") in all_members:
+    default_member_idx = signup_member_options.index(st.session_state["last_signup_member"])
 
 selected_member_for_signup = signup_cols[0].selectbox(
     "選擇你的遊戲ID（若無請先於上方註冊）",
-    options=[""] + member_keys_sorted,
+    options=signup_member_options,
     index=default_member_idx,
     key="weekly_signup_member_select",
     help="此處只需選擇ID並勾選可參加的時間與次數"
 )
 
-this_range_q = f"{get_start_of_week(date.today()).strftime('%m/%d')} ~ {(get_start_of_week(date.today()) + timedelta(days=6)).strftime('%m/%d')}"
-next_start_q = get_start_of_week(date.today()) + timedelta(days=7)
-next_range_q = f"{next_start_q.strftime('%m/%d')} ~ {(next_start_q + timedelta(days=6)).strftime('%m/%d')}"
-label_this_q = f"本週({this_range_q})"
-label_next_q = f"下週({next_range_q})"
-week_choice_quick = signup_cols[1].radio("週次", [label_this_q, label_next_q], horizontal=True, key="weekly_signup_week_choice")
+# 本週起始日只計算一次，週次區間字串交給已快取的 get_week_range
+weeks_q = week_labels(date.today())
+week_choice_quick = signup_cols[1].radio("週次", [weeks_q.label_this, weeks_q.label_next], horizontal=True, key="weekly_signup_week_choice")
 
-start_thu_quick = get_start_of_week(date.today()) if week_choice_quick == label_this_q else (get_start_of_week(date.today()) + timedelta(days=7))
-week_key_quick = start_thu_quick.strftime('%Y-%m-%d')
+is_this_week_q = week_choice_quick == weeks_q.label_this
+start_thu_quick = weeks_q.start_this if is_this_week_q else weeks_q.start_next
+week_key_quick = weeks_q.key_this if is_this_week_q else weeks_q.key_next
+
+def _iter_signup_rows(members: dict, week_key: str, dungeon_filter: str):
+    """逐列產生已報名成員表格的資料 (名稱, 職業, 等級, 副本, 次數, *七天勾選)。
+    新舊資料結構皆由 _week_view 統一；該週沒有勾選任何一天的副本不產生資料列。
+    """
+    # 迴圈內只用區域變數，避免每列重複查全域名稱
+    weekday_plain = tuple(WEEKDAY_PLAIN)
+    filter_dungeon = None if dungeon_filter == "全部" else dungeon_filter
+    for name, info in members.items():
+        sources = _week_view(info, week_key)
+        if not sources:
+            continue
+        job = str(info.get("job", ""))
+        level = str(info.get("level", ""))
+        for dungeon_val, wa, pc in sources:
+            if filter_dungeon is not None and dungeon_val != filter_dungeon:
+                continue
+            day_flags = tuple(bool(wa.get(p, False)) for p in weekday_plain)
+            if not any(day_flags):
+                continue
+            participation_count_str = "" if pc in (None, "") else str(pc)
+            yield (name, job, level, dungeon_val, participation_count_str, *day_flags)
 
 def _get_member_default_dungeon(info_dict, week_key):
     """取得成員在該週的預設副本選擇。"""
     if not isinstance(info_dict, dict):
         return DEFAULT_DUNGEON
-    weekly_data = info_dict.get("weekly_data", {}) if isinstance(info_dict.get("weekly_data", {}), dict) else {}
-    week_entry = weekly_data.get(week_key)
+    week_entry = _safe_dict(_safe_dict(info_dict, "weekly_data"), week_key)
     # 新結構：week_entry 為 { dungeon_name: {...} }
-    if isinstance(week_entry, dict) and any(k in DUNGEON_OPTIONS for k in week_entry.keys()):
+    if not _DUNGEON_SET.isdisjoint(week_entry):
         # 若只有一個副本，就用它；多個則優先使用 DEFAULT_DUNGEON，否則任一
         dungeon_keys = list(week_entry.keys())
         if len(dungeon_keys) == 1:
@@ -530,13 +731,45 @@ def _get_member_default_dungeon(info_dict, week_key):
             return DEFAULT_DUNGEON
         return normalize_dungeon(dungeon_keys[0])
     # 舊結構：單一物件含 dungeon 欄位
-    if isinstance(week_entry, dict) and "dungeon" in week_entry:
+    if "dungeon" in week_entry:
         return normalize_dungeon(week_entry.get("dungeon", DEFAULT_DUNGEON))
     if "weekly_dungeon" in info_dict:
         return normalize_dungeon(info_dict.get("weekly_dungeon"))
     return DEFAULT_DUNGEON
 
-dungeon_default_selection = DEFAULT_DUNGEON
+@dataclass(slots=True)
+class WeekSignupState:
+    """成員某週某副本的報名預設值（巢狀資料已解析完畢）。"""
+    availability: dict
+    participation: int
+
+def _resolve_signup_state(info_dict: dict, week_key: str, dungeon: str) -> WeekSignupState:
+    """一次走完 weekly_data → 週次 → 副本 的查找，回傳表單元件要用的預設值。"""
+    week_entry = _safe_dict(_safe_dict(info_dict, "weekly_data"), week_key)
+    dungeon_entry = _safe_dict(week_entry, dungeon)
+
+    participation = 1
+    for raw in (dungeon_entry.get("participation_count", ""), info_dict.get("weekly_participation_count", "")):
+        if str(raw).isdigit():
+            participation = int(raw)
+            break
+    if participation not in (1, 2):
+        participation = 1
+    return WeekSignupState(
+        availability=dungeon_entry.get("availability") or {},
+        participation=participation,
+    )
+
+def _is_unchanged_signup(info_dict: dict, week_key: str, dungeon: str, availability: dict, participation) -> bool:
+    """送出內容與已儲存的報名（含舊欄位）完全相同時回傳 True，可略過寫入。"""
+    entry = _safe_dict(_safe_dict(_safe_dict(info_dict, "weekly_data"), week_key), dungeon)
+    return (
+        bool(entry)
+        and entry.get("availability") == availability
+        and str(entry.get("participation_count", "")) == str(participation)
+        and info_dict.get("weekly_week_start") == week_key
+        and info_dict.get("weekly_dungeon") == dungeon
+    )
 
 dungeon_default_selection = DEFAULT_DUNGEON
 
@@ -546,49 +779,51 @@ if selected_member_for_signup:
     # 預設參與次數
     info_q = all_members.get(selected_member_for_signup, {})
     dungeon_default_selection = _get_member_default_dungeon(info_q, week_key_quick)
-    dungeon_choice_idx = DUNGEON_OPTIONS.index(dungeon_default_selection) if dungeon_default_selection in DUNGEON_OPTIONS else 0
+    dungeon_choice_idx = DUNGEON_INDEX.get(dungeon_default_selection, 0)
     dungeon_choice = signup_cols[2].selectbox(
         "副本",
         options=DUNGEON_OPTIONS,
         index=dungeon_choice_idx,
         key=f"weekly_signup_dungeon_{selected_member_for_signup}",  # 切換週次時保留當前使用者選擇
     )
-    _wdata_q = info_q.get("weekly_data", {}) if isinstance(info_q.get("weekly_data", {}), dict) else {}
-    week_entry_q = _wdata_q.get(week_key_quick, {}) if isinstance(_wdata_q.get(week_key_quick, {}), dict) else {}
-    dungeon_entry_q = week_entry_q.get(dungeon_choice, {}) if isinstance(week_entry_q, dict) else {}
-    if str(dungeon_entry_q.get("participation_count", "")).isdigit():
-        participation_default_q = int(dungeon_entry_q.get("participation_count", 1))
-    elif str(info_q.get("weekly_participation_count", "")).isdigit():
-        participation_default_q = int(info_q.get("weekly_participation_count", 1))
-    else:
-        participation_default_q = 1
+    signup_state_q = _resolve_signup_state(info_q, week_key_quick, dungeon_choice)
+    # 成員/週次/副本 共用的元件 key 後綴，只組一次
+    signup_key_suffix = "_".join((selected_member_for_signup, week_key_quick, dungeon_choice))
 
     participation_count_q = signup_cols[3].selectbox(
         "參與次數",
         options=[1, 2],
-        index=[1, 2].index(participation_default_q),
-        key=f"weekly_signup_participation_{selected_member_for_signup}_{week_key_quick}_{dungeon_choice}",
+        index=signup_state_q.participation - 1,
+        key=f"weekly_signup_participation_{signup_key_suffix}",
     )
 
     # 日期勾選（快速）
-    day_names_q = ["星期四", "星期五", "星期六", "星期日", "星期一", "星期二", "星期三"]
-    days_q = [(start_thu_quick + timedelta(days=i), day_names_q[i]) for i in range(7)]
+    days_q = [(start_thu_quick + timedelta(days=i), label) for i, label in enumerate(WEEKDAY_PLAIN)]
 
     # 預設值（依該成員該週資料）
-    weekly_default_q = {}
-    if isinstance(week_entry_q, dict) and dungeon_choice in week_entry_q:
-        weekly_default_q = week_entry_q.get(dungeon_choice, {}).get("availability", {}) or {}
-
-    cols_q = st.columns(7)
-    weekly_availability_q = {}
-    for i, (d, label) in enumerate(days_q):
-        weekly_availability_q[label] = cols_q[i].checkbox(
-            f"{label}\n{d.strftime('%m/%d')}",
-            value=bool(weekly_default_q.get(label, False)),
-            key=f"weekly_q_{selected_member_for_signup}_{week_key_quick}_{dungeon_choice}_{label}",
-        )
-
-    if st.button("📨 送出本次報名", type="primary"):
+    weekly_default_q = signup_state_q.availability
+
+    # 單列勾選表格：一個元件取代七個 checkbox，減少每次 rerun 的元件數
+    edited_availability_q = st.data_editor(
+        [{label: bool(weekly_default_q.get(label, False)) for _, label in days_q}],
+        column_config={
+            label: st.column_config.CheckboxColumn(f"{label} {d.strftime('%m/%d')}")
+            for d, label in days_q
+        },
+        num_rows="fixed",
+        hide_index=True,
+        use_container_width=True,
+        key=f"weekly_q_{signup_key_suffix}",
+    )
+    weekly_availability_q = {label: bool(edited_availability_q[0].get(label, False)) for _, label in days_q}
+
+    submitted_q = st.button("📨 送出本次報名", type="primary")
+    if submitted_q and _is_unchanged_signup(info_q, week_key_quick, dungeon_choice, weekly_availability_q, participation_count_q):
+        # 與已儲存內容相同：不送出寫入，也不更新 last_updated
+        st.info("報名內容沒有變更，無需重新送出。")
+    elif submitted_q and not is_valid_member_name(selected_member_for_signup):
+        st.error("成員名稱包含 . $ # [ ] / 等字元，無法儲存報名，請重新註冊角色。")
+    elif submitted_q:
         now_iso_q = datetime.now().isoformat(timespec="seconds")
         member_dict_q = st.session_state.data.setdefault("members", {}).get(selected_member_for_signup, {})
         weekly_data_q = member_dict_q.setdefault("weekly_data", {})
@@ -616,109 +851,45 @@ if selected_member_for_signup:
                 st.stop()
 
         # 寫入目前副本資料
-        week_entry_save[dungeon_choice] = {
+        dungeon_payload_q = {
             "availability": weekly_availability_q,
             "participation_count": participation_count_q,
             "last_updated": now_iso_q,
         }
+        week_entry_save[dungeon_choice] = dungeon_payload_q
         # 舊欄位同步（相容）
-        member_dict_q.update({
+        legacy_fields_q = {
             "weekly_availability": weekly_availability_q,
             "weekly_last_updated": now_iso_q,
             "weekly_week_start": week_key_quick,
             "weekly_participation_count": participation_count_q,
             "weekly_dungeon": dungeon_choice,
-        })
+        }
+        member_dict_q.update(legacy_fields_q)
         st.session_state.data["members"][selected_member_for_signup] = member_dict_q
-        sync_data_and_save()
+        save_member_week(selected_member_for_signup, week_key_quick, dungeon_choice, dungeon_payload_q, legacy_fields_q)
+        # 已報名成員表格在本段之後才繪製，會直接讀到剛更新的 session_state，不需再 rerun 一次
         st.success("✅ 已送出報名！")
-        st.rerun()
 
 
 st.markdown("---")
 
 st.subheader("🙋已報名成員")
-today = date.today()
-start_this = get_start_of_week(today)
-this_range_l = f"{start_this.strftime('%m/%d')} ~ {(start_this + timedelta(days=6)).strftime('%m/%d')}"
-next_start_l = start_this + timedelta(days=7)
-next_range_l = f"{next_start_l.strftime('%m/%d')} ~ {(next_start_l + timedelta(days=6)).strftime('%m/%d')}"
-label_this_l = f"本週({this_range_l})"
-label_next_l = f"下週({next_range_l})"
+weeks_l = week_labels(date.today())
 list_cols = st.columns([2, 1])
-list_week_choice = list_cols[0].radio("顯示週次", [label_this_l, label_next_l], horizontal=True, key="list_week_choice")
+list_week_choice = list_cols[0].radio("顯示週次", [weeks_l.label_this, weeks_l.label_next], horizontal=True, key="list_week_choice")
 dungeon_filter = list_cols[1].selectbox("副本", options=["全部"] + DUNGEON_OPTIONS, key="list_dungeon_filter")
-week_start = start_this if list_week_choice == label_this_l else start_this + timedelta(days=7)
-weekday_labels = [
-    f"星期四({(week_start + timedelta(days=0)).strftime('%m/%d')})",
-    f"星期五({(week_start + timedelta(days=1)).strftime('%m/%d')})",
-    f"星期六({(week_start + timedelta(days=2)).strftime('%m/%d')})",
-    f"星期日({(week_start + timedelta(days=3)).strftime('%m/%d')})",
-    f"星期一({(week_start + timedelta(days=4)).strftime('%m/%d')})",
-    f"星期二({(week_start + timedelta(days=5)).strftime('%m/%d')})",
-    f"星期三({(week_start + timedelta(days=6)).strftime('%m/%d')})",
-]
-weekday_plain = ["星期四","星期五","星期六","星期日","星期一","星期二","星期三"]
-
-rows = []
-show_week = week_start.strftime('%Y-%m-%d')
-for name, info in st.session_state.data.get("members", {}).items():
-    # 優先從 weekly_data 讀取該週資料
-    weekly_data = info.get("weekly_data", {}) if isinstance(info.get("weekly_data", {}), dict) else {}
-    week_obj = weekly_data.get(show_week)
-
-    # 沒有週資料時，嘗試使用舊欄位（僅支援單副本舊資料）
-    if not isinstance(week_obj, dict) or not week_obj:
-        if info.get("weekly_week_start") != show_week:
-            continue
-        wa = info.get("weekly_availability", {}) or {}
-        pc = info.get("weekly_participation_count", "")
-        dungeon_val = normalize_dungeon(info.get("weekly_dungeon", DEFAULT_DUNGEON))
-        if dungeon_filter != "全部" and dungeon_val != dungeon_filter:
-            continue
-        if not any(bool(wa.get(p, False)) for p in weekday_plain):
-            continue
-        participation_count_str = "" if pc in (None, "") else str(pc)
-        row = {
-            "名稱": name,
-            "職業": str(info.get("job", "")),
-            "等級": str(info.get("level", "")),
-            "副本": dungeon_val,
-            "次數": participation_count_str
-        }
-        for plain, label in zip(weekday_plain, weekday_labels):
-            row[label] = "✅" if wa.get(plain, False) else ""
-        rows.append(row)
-        continue
-
-    # 新結構：同一週可有多個副本
-    for dungeon_key, dungeon_obj in week_obj.items():
-        if not isinstance(dungeon_obj, dict):
-            continue
-        dungeon_val = normalize_dungeon(dungeon_key or dungeon_obj.get("dungeon", DEFAULT_DUNGEON))
-        if dungeon_filter != "全部" and dungeon_val != dungeon_filter:
-            continue
-        wa = dungeon_obj.get("availability", {}) or {}
-        pc = dungeon_obj.get("participation_count", "")
-        if not any(bool(wa.get(p, False)) for p in weekday_plain):
-            continue
-        participation_count_str = "" if pc in (None, "") else str(pc)
-        row = {
-            "名稱": name,
-            "職業": str(info.get("job", "")),
-            "等級": str(info.get("level", "")),
-            "副本": dungeon_val,
-            "次數": participation_count_str
-        }
-        for plain, label in zip(weekday_plain, weekday_labels):
-            row[label] = "✅" if wa.get(plain, False) else ""
-        rows.append(row)
+is_this_week_l = list_week_choice == weeks_l.label_this
+week_start = weeks_l.start_this if is_this_week_l else weeks_l.start_next
+weekday_labels = list(weekday_column_labels(week_start))
+
+show_week = weeks_l.key_this if is_this_week_l else weeks_l.key_next
+signup_rows = _iter_signup_rows(all_members, show_week, dungeon_filter)
 
-df_members = pd.DataFrame(rows, columns=["名稱","職業","等級","副本","次數"] + weekday_labels)
+df_members = build_signup_dataframe(signup_rows, weekday_labels)
 st.dataframe(df_members, hide_index=True)
 
 st.markdown("---")
-ai_prompt_text = build_prompt_from_table(df_members)
 st.subheader("🤖 AI 分隊提示詞")
 st.caption("可複製下方文字並貼到分隊協作提示中，內容已包含目前本週顯示的成員資訊。")
 if "latus_prompt_triggered" not in st.session_state:
@@ -741,7 +912,7 @@ with st.container():
 
     if st.session_state.get("latus_prompt_triggered") and st.session_state.get("latus_prompt"):
         prompt_to_copy = st.session_state.latus_prompt
-        safe_prompt = json.dumps(prompt_to_copy)
+        safe_prompt = html.escape(prompt_to_copy)
         components.html(
             f"""
             <div style="display:flex;align-items:center;gap:0.5rem;">
@@ -750,8 +921,9 @@ with st.container():
               </button>
               <span id="copyStatus" style="font-size:0.85rem;color:#008000;"></span>
             </div>
+            <textarea id="promptText" hidden>{safe_prompt}</textarea>
             <script>
-            const textToCopy = {safe_prompt};
+            const textToCopy = document.getElementById("promptText").value;
             const btn = document.getElementById("copyPrompt");
             const statusEl = document.getElementById("copyStatus");
             btn.addEventListener("click", () => {{
@@ -1,37 +1,38 @@
+from __future__ import annotations
+
 import json
-import streamlit as st
 import pandas as pd
-from datetime import datetime, timedelta, date
+import streamlit as st
+from datetime import timedelta, date
+from functools import lru_cache
 from typing import Tuple
-
-# Firebase Admin SDK
-import firebase_admin
-from firebase_admin import credentials, db as firebase_db
+from urllib.parse import urlsplit
 
 MAX_TEAM_SIZE = 6
 UNAVAILABLE_KEY = "__UNAVAILABLE__"
 
 
+def _blank_member() -> dict:
+    # 每次回傳新的 dict，呼叫端會直接修改成員欄位
+    return {"name": "", "job": "", "level": "", "atk": ""}
+
+
 def _parse_firebase_url(full_url: str) -> Tuple[str, str]:
+    # 例如 https://example-default-rtdb.firebaseio.com/team_info ->
+    #   (https://example-default-rtdb.firebaseio.com, /team_info)；區域性的 *.firebasedatabase.app 亦同
     if not full_url:
         raise ValueError("firebase.url is empty in secrets")
-    url = full_url.strip()
-    if url.endswith(".json"):
-        url = url[:-5]
-    url = url.rstrip("/")
-    marker = ".com"
-    idx = url.find(marker)
-    if idx == -1:
-        raise ValueError("Invalid Firebase RTDB URL: missing '.com'")
-    base = url[: idx + len(marker)]
-    path = url[idx + len(marker) :]
-    path = path if path else "/"
-    if not path.startswith("/"):
-        path = "/" + path
-    return base, path
+    parts = urlsplit(full_url.strip().removesuffix(".json").rstrip("/"))
+    if not parts.scheme or not parts.netloc:
+        raise ValueError("Invalid Firebase RTDB URL: missing scheme or host")
+    return f"{parts.scheme}://{parts.netloc}", parts.path or "/"
 
 
 def _init_firebase_admin_if_needed():
+    # Firebase Admin SDK 延後到第一次存取資料庫才載入，縮短冷啟動時間
+    import firebase_admin
+    from firebase_admin import credentials
+
     if not firebase_admin._apps:
         service_account_info = dict(st.secrets["gcp_service_account"])  # from secrets.toml / cloud secrets
         database_url_full = st.secrets["firebase"]["url"]
@@ -42,29 +43,36 @@ def _init_firebase_admin_if_needed():
         })
 
 
+@st.cache_resource(show_spinner=False)
 def _get_rtdb_ref():
+    from firebase_admin import db as firebase_db
+
     _init_firebase_admin_if_needed()
     database_url_full = st.secrets["firebase"]["url"]
     _, ref_path = _parse_firebase_url(database_url_full)
     return firebase_db.reference(ref_path)
 
 
+@lru_cache(maxsize=16)
 def get_start_of_week(base_date: date) -> date:
     days_since_thu = (base_date.weekday() - 3) % 7
     return base_date - timedelta(days=days_since_thu)
 
 
-def get_default_schedule_for_week():
-    return {
-        "proposed_slots": {},
-        "availability": {UNAVAILABLE_KEY: []},
-    }
+@st.cache_data(ttl=30, show_spinner=False)
+def _fetch_snapshot():
+    return _get_rtdb_ref().get()
+
+
+def _invalidate_snapshots():
+    # 快照快取由所有 session 共用；寫入成功後一律清除，兩個頁面（本頁 _fetch_snapshot、
+    # 主頁 _fetch_raw_data）的函式無法互相引用，故整個 st.cache_data 一起清掉
+    st.cache_data.clear()
 
 
 def load_data():
     try:
-        ref = _get_rtdb_ref()
-        data = ref.get() or {"teams": [], "members": {}}
+        data = _fetch_snapshot() or {"teams": [], "members": {}}
         data.setdefault("teams", [])
         data.setdefault("members", {})
         return data
@@ -73,58 +81,42 @@ def load_data():
         return {"teams": [], "members": {}}
 
 
-def save_data(data):
+def save_teams(teams: list):
+    """整份隊伍清單一次寫回（刪除隊伍會位移索引時使用）；members 節點不重送。"""
     try:
-        ref = _get_rtdb_ref()
-        ref.set(data)
+        _get_rtdb_ref().update({"teams": teams})
+        _invalidate_snapshots()
     except Exception as e:
         st.error(f"❌ 儲存資料時發生未預期的錯誤：{e}")
 
 
-def build_team_text(team):
-    today = date.today()
-    start_of_this_week_str = get_start_of_week(today).strftime('%Y-%m-%d')
-    remark = team.get('team_remark', '')
-    time_display = remark if remark else "時間待定"
-    title = f"【{team['team_name']} 徵人】"
-    time = f"時間：{time_display}"
-    remark_text = f"備註：{remark}" if remark else ""
-    current_members = [m for m in team.get("member", []) if m.get("name")]
-    members_lines = [
-        f"{i}. {member.get('level','')} {member.get('job','')} {member.get('name')}".strip()
-        for i, member in enumerate(current_members, 1)
-    ]
-    member_text = "✅ 目前成員：\n" + "\n".join(members_lines) if members_lines else ""
-    missing_count = MAX_TEAM_SIZE - len(current_members)
-    missing_text = f"📋 尚缺 {missing_count} 人，歡迎私訊！" if missing_count > 0 else "🎉 隊伍已滿，可先排後補！"
-    return "\n\n".join(filter(None, [title, time, remark_text, member_text, missing_text])).strip()
+def save_team_fields(team_idx: int, fields: dict):
+    """只更新單一隊伍的指定欄位（一次 PATCH，不重送整棵資料樹）。"""
+    try:
+        _get_rtdb_ref().child(f"teams/{team_idx}").update(fields)
+        _invalidate_snapshots()
+    except Exception as e:
+        st.error(f"❌ 儲存資料時發生未預期的錯誤：{e}")
 
 
+@lru_cache(maxsize=16)
 def get_week_range(base_date: date) -> str:
     start_of_week = get_start_of_week(base_date)
     end_of_week = start_of_week + timedelta(days=6)
     return f"{start_of_week.strftime('%m/%d')} ~ {end_of_week.strftime('%m/%d')}"
 
 
-def generate_weekly_schedule_days(start_date: date) -> list[str]:
-    start_of_week = get_start_of_week(start_date)
-    weekdays_zh = ["一", "二", "三", "四", "五", "六", "日"]
-    schedule_days = [
-        f"星期{weekdays_zh[(start_of_week + timedelta(days=i)).weekday()]} ({(start_of_week + timedelta(days=i)).strftime('%m-%d')})"
-        for i in range(7)
-    ]
-    return schedule_days
-
-
 WEEKDAY_PLAIN = ["星期四", "星期五", "星期六", "星期日", "星期一", "星期二", "星期三"]
 
 
-def get_weekday_label_pairs(start_date: date) -> Tuple[list[str], list[str]]:
-    weekday_with_date = [
+@lru_cache(maxsize=16)
+def get_weekday_label_pairs(start_date: date) -> Tuple[tuple[str, ...], tuple[str, ...]]:
+    # 快取共用，故回傳不可變的 tuple
+    weekday_with_date = tuple(
         f"{label}({(start_date + timedelta(days=i)).strftime('%m/%d')})"
         for i, label in enumerate(WEEKDAY_PLAIN)
-    ]
-    return WEEKDAY_PLAIN, weekday_with_date
+    )
+    return tuple(WEEKDAY_PLAIN), weekday_with_date
 
 
 def _get_member_weekly_availability(name: str, members_data: dict, week_key: str) -> tuple[dict, dict]:
@@ -209,7 +201,7 @@ def parse_uploaded_team_payload(payload: dict) -> list[dict]:
         normalized_members = [_normalize_member_payload(m) for m in members if m is not None]
         normalized_members = normalized_members[:MAX_TEAM_SIZE]
         while len(normalized_members) < MAX_TEAM_SIZE:
-            normalized_members.append({"name": "", "job": "", "level": "", "atk": ""})
+            normalized_members.append(_blank_member())
         normalized.append({
             "team_name": f"第{idx+1}組",
             "time_label": time_label,
@@ -227,6 +219,8 @@ st.info("💡 **手動分隊**：建立和管理隊伍，手動安排成員加
 data = load_data()
 teams = data.get("teams", [])
 all_members = data.get("members", {})
+# 成員名稱排序每次 rerun 只做一次，查詢選單與各隊伍的名稱欄位共用
+member_name_options = ("", *sorted(all_members))
 
 today = date.today()
 start_of_this_week = get_start_of_week(today)
@@ -240,10 +234,9 @@ if "uploaded_team_data_key" not in st.session_state:
 
 # 搜尋功能
 st.subheader("🔍 成員隊伍查詢")
-member_names_for_search = [""] + sorted(list(all_members.keys()))
 selected_member_for_search = st.selectbox(
     "選擇成員查看其參與的隊伍",
-    member_names_for_search,
+    member_name_options,
     key="member_search_manual",
     help="快速查詢特定成員目前參與的所有隊伍"
 )
@@ -252,10 +245,12 @@ if selected_member_for_search:
     # 查找該成員參與的所有隊伍
     participating_teams = []
     for idx, team in enumerate(teams):
-        team_members = [m.get("name", "") for m in team.get("member", [])]
-        if selected_member_for_search in team_members:
-            # 獲取該成員在隊伍中的詳細資訊
-            member_info = next((m for m in team.get("member", []) if m.get("name") == selected_member_for_search), {})
+        # 找到第一個符合的成員即停止，同時取得詳細資訊（略過 RTDB 中可能出現的空欄位）
+        member_info = next(
+            (m for m in team.get("member", []) if isinstance(m, dict) and m.get("name") == selected_member_for_search),
+            None,
+        )
+        if member_info is not None:
             participating_teams.append({
                 "隊伍名稱": team.get("team_name", f"隊伍 {idx+1}"),
                 "職業": member_info.get("job", ""),
@@ -444,18 +439,16 @@ if uploaded_json:
 else:
     st.info("尚未上傳任何 JSON 檔案。")
 
-team_view_week = {}
+# 展開中的隊伍索引；收合的隊伍不執行內容（表單、表格），減少每次 rerun 的元件數
+if "open_team_idx" not in st.session_state:
+    st.session_state.open_team_idx = set()
 
-for idx, team in enumerate(teams):
-    if "team_view_week" not in st.session_state:
-        st.session_state.team_view_week = {}
-    if idx not in st.session_state.team_view_week:
-        st.session_state.team_view_week[idx] = start_of_this_week_str
-
-    view_week_start_str = st.session_state.team_view_week[idx]
-    view_week_start_date = datetime.strptime(view_week_start_str, '%Y-%m-%d').date()
+# 週次切換的標籤與日期對所有隊伍相同，迴圈外只算一次
+start_of_next_week = start_of_this_week + timedelta(days=7)
+label_this = f"本週({get_week_range(start_of_this_week)})"
+label_next = f"下週({get_week_range(start_of_next_week)})"
 
-    schedule_to_display = team.get("schedules", {}).get(view_week_start_str, get_default_schedule_for_week())
+for idx, team in enumerate(teams):
     team_time_remark = team.get('team_remark', '')
 
     # 隊伍狀態資訊
@@ -466,7 +459,14 @@ for idx, team in enumerate(teams):
     time_info = f"｜⏰ {team_time_remark}" if team_time_remark else "｜⏰ 時間待定"
     
     expander_label = f"{status_icon} **{team['team_name']}** {time_info}"
-    with st.expander(expander_label, expanded=False):
+    is_open = idx in st.session_state.open_team_idx
+    with st.container(border=True):
+        if st.button(f"{'🔽' if is_open else '▶️'} {expander_label}", key=f"toggle_team_{idx}", use_container_width=True):
+            st.session_state.open_team_idx ^= {idx}
+            is_open = not is_open
+        if not is_open:
+            continue
+
         # 隊伍統計
         col1, col2, col3 = st.columns([2, 1, 1])
         with col1:
@@ -489,13 +489,10 @@ for idx, team in enumerate(teams):
 
         with tab1:
             # 週次切換（本週 / 下週），顯示日期範圍
-            this_range = get_week_range(start_of_this_week)
-            next_range = get_week_range(start_of_this_week + timedelta(days=7))
-            label_this = f"本週({this_range})"
-            label_next = f"下週({next_range})"
             view_choice = st.radio("顯示週次", [label_this, label_next], horizontal=True, key=f"member_list_week_{idx}")
-            week_start_date = start_of_this_week if view_choice == label_this else (start_of_this_week + timedelta(days=7))
-            week_key_str = week_start_date.strftime('%Y-%m-%d')
+            is_this_week = view_choice == label_this
+            week_start_date = start_of_this_week if is_this_week else start_of_next_week
+            week_key_str = start_of_this_week_str if is_this_week else start_of_next_week_str
             weekday_plain, weekday_with_date = get_weekday_label_pairs(week_start_date)
             with st.form(f"team_form_{idx}", clear_on_submit=False):
                 c1, c2 = st.columns(2)
@@ -505,15 +502,14 @@ for idx, team in enumerate(teams):
 
                 current_members_list = team.get("member", [])
                 if len(current_members_list) != MAX_TEAM_SIZE:
-                    current_members_list.extend([{"name": "", "job": "", "level": "", "atk": ""} for _ in range(MAX_TEAM_SIZE - len(current_members_list))])
+                    current_members_list.extend(_blank_member() for _ in range(MAX_TEAM_SIZE - len(current_members_list)))
                 current_members_list = current_members_list[:MAX_TEAM_SIZE]
 
-                # 合併為單一 DataFrame，並加入上方欄位與可參加日期（依週次切換）
-                member_names_for_team_select = [""] + sorted(list(all_members.keys()))
+                # 合併為單一表格（list of dict 直接交給 data_editor），並加入上方欄位與可參加日期（依週次切換）
                 rows = []
                 for m in current_members_list:
                     nm = m.get("name", "")
-                    base_info = all_members.get(nm, {}) if nm in all_members else {}
+                    base_info = all_members.get(nm) or {}
                     job = base_info.get("job", m.get("job", ""))
                     level = base_info.get("level", m.get("level", ""))
                     atk = base_info.get("atk", m.get("atk", ""))
@@ -529,15 +525,10 @@ for idx, team in enumerate(teams):
                     for p, w in zip(weekday_plain, weekday_with_date):
                         row[w] = "✅" if wa.get(p, False) else ""
                     rows.append(row)
-                if rows:
-                    df_combined = pd.DataFrame(rows, columns=["名稱","職業","等級","表攻"] + weekday_with_date)
-                else:
-                    df_combined = pd.DataFrame(columns=["名稱","職業","等級","表攻"] + weekday_with_date)
-
-                edited_df = st.data_editor(df_combined, key=f"editor_{idx}", num_rows="fixed",
+                edited_rows = st.data_editor(rows, key=f"editor_{idx}", num_rows="fixed",
                     column_config={
                         "_index": None,
-                        "名稱": st.column_config.SelectboxColumn("名稱", options=member_names_for_team_select, required=False),
+                        "名稱": st.column_config.SelectboxColumn("名稱", options=member_name_options, required=False),
                         "職業": st.column_config.TextColumn("職業", disabled=True),
                         "等級": st.column_config.TextColumn("等級", disabled=True),
                         "表攻": st.column_config.TextColumn("表攻", disabled=True),
@@ -550,27 +541,32 @@ for idx, team in enumerate(teams):
                 btn_cols = st.columns([2, 1, 1])
                 if btn_cols[0].form_submit_button(f"💾 儲存變更", type="primary"):
                     updated_members = [
-                        {"name": row["名稱"], **all_members.get(row["名稱"], {})} if row["名稱"] else {"name": "", "job": "", "level": "", "atk": ""}
-                        for _, row in edited_df.iterrows()
+                        {"name": row["名稱"], **all_members.get(row["名稱"], {})} if row["名稱"] else _blank_member()
+                        for row in edited_rows
                     ]
-                    data["teams"][idx].update({
+                    team_fields = {
                         "team_name": team_name,
                         "team_remark": team_remark,
                         "member": updated_members
-                    })
-                    save_data(data)
+                    }
+                    team.update(team_fields)
+                    save_team_fields(idx, team_fields)
                     st.success(f"隊伍 '{team_name}' 的資料已更新！")
                     st.rerun()
 
                 if btn_cols[1].form_submit_button(f"🔄 清空成員"):
-                    data["teams"][idx]["member"] = [{"name": "", "job": "", "level": "", "atk": ""} for _ in range(MAX_TEAM_SIZE)]
-                    save_data(data)
+                    team["member"] = [_blank_member() for _ in range(MAX_TEAM_SIZE)]
+                    save_team_fields(idx, {"member": team["member"]})
                     st.success(f"隊伍 '{team['team_name']}' 的成員已清空！")
                     st.rerun()
 
                 if btn_cols[2].form_submit_button(f"🗑️ 刪除隊伍"):
                     deleted_name = data["teams"].pop(idx)["team_name"]
-                    save_data(data)
+                    # 後面的隊伍索引前移一格，展開狀態跟著調整
+                    st.session_state.open_team_idx = {
+                        i - (i > idx) for i in st.session_state.open_team_idx if i != idx
+                    }
+                    save_teams(data["teams"])
                     st.success(f"隊伍 '{deleted_name}' 已被刪除！")
                     st.rerun()
 